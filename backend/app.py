@@ -1,49 +1,669 @@
 import os
-import shutil
-import uuid
-from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, Header
-from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+import asyncio
+import hashlib
+import hmac
+import io
+import itertools
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import secrets
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import RLock
+from urllib.parse import quote
+from collections import OrderedDict, deque
+import aiofiles
+import anyio
+import numpy as np
+import orjson
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
+from typing import Any, Optional
 import gtts.lang
-from backend.rag_utils import load_document, create_vector_store, create_rag_chain, store_rag_answer
-from backend.tts_conversion import convert_text_to_audio
+from backend.rag_utils import (
+    load_document,
+    get_embedder,
+    embedding_namespace,
+    create_vector_store,
+    create_rag_chain,
+    vector_store_is_empty,
+    store_rag_answer,
+    persist_qa_history,
+)
+from backend.tts_conversion import stream_text_to_audio
 
 from dotenv import load_dotenv
-import os
 
-# Load the .env file
-load_dotenv()
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
+
+try:
+    import faiss
+except ImportError:  # semantic cache falls back to NumPy
+    faiss = None
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # exact-match answer cache is skipped
+    aioredis = None
+
+# Fallback for servers that don't pick the loop themselves (e.g. `uvicorn backend.app:app`)
+if uvloop is not None:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+logger = logging.getLogger(__name__)
+
+# Load the .env file (production gets its environment from the process manager)
+if os.getenv("ENV") != "prod":
+    load_dotenv()
 
-print("🔑 GOOGLE_API_KEY loaded:", os.getenv("GOOGLE_API_KEY"))
+# =====================================
+# LOGGING
+# =====================================
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_QUEUE = queue.SimpleQueue()
+
+
+def configure_logging() -> QueueListener:
+    """Route all records through a queue so the event loop never blocks on stdout."""
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    # Built by hand: dictConfig rejects a queue object for QueueHandler on some 3.12/3.13 releases
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(LOG_QUEUE))
+    root.setLevel(LOG_LEVEL)
+    listener = QueueListener(LOG_QUEUE, console, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def _init_worker_logging():
+    """Ingest worker processes can't reach the parent's log queue; log to stderr directly."""
+    logging.basicConfig(
+        level=LOG_LEVEL,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+        force=True,
+    )
+
+
+# =====================================
+# CONSTANTS
+# =====================================
+# Resolved and created once here instead of on every request
+BASE_DIR = Path(__file__).resolve().parent
+TEMP_DIR = BASE_DIR / "temp_files"
+AUDIO_CACHE_DIR = TEMP_DIR / "audio_cache"
+CHROMA_DIR = BASE_DIR / "chroma_db"
+for _dir in (TEMP_DIR, AUDIO_CACHE_DIR, CHROMA_DIR):
+    _dir.mkdir(parents=True, exist_ok=True)
 
 
 # =====================================
 # FASTAPI APP CONFIGURATION
 # =====================================
-app = FastAPI(title="RAG Document AI Backend")
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # For dev; restrict in production
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+class ORJSONResponse(JSONResponse):
+    """JSONResponse rendered by orjson (FastAPI's own ORJSONResponse is deprecated)."""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    log_listener = configure_logging()
+    # One embedding model per process, shared by every upload
+    app.state.embedder = get_embedder()
+    if ANSWER_BATCHING:
+        answer_batcher.start()
+    history_flusher.start()
+    yield
+    await answer_batcher.stop()
+    await history_flusher.stop()
+    await exact_cache.close()
+    PROC_POOL.shutdown(wait=False, cancel_futures=True)
+    log_listener.stop()
+
+
+app = FastAPI(
+    title="RAG Document AI Backend",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
 )
 
+# Static Access-Control-* headers shared by preflight and normal responses
+CORS_HEADERS: list[tuple[bytes, bytes]] = [
+    (b"access-control-allow-credentials", b"true"),
+    (b"access-control-allow-methods", b"GET, POST, PUT, PATCH, DELETE, OPTIONS"),
+    (b"access-control-max-age", b"600"),
+]
+
+
+class CORS:
+    """Pure ASGI CORS middleware: adds headers in-place, no Request/Response objects."""
+
+    def __init__(self, app, origins):
+        self.app = app
+        self.allow_all = "*" in origins
+        self.origins = {o.encode("latin-1") for o in origins}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = dict(scope["headers"])
+        origin = request_headers.get(b"origin")
+        if origin is None or not (self.allow_all or origin in self.origins):
+            await self.app(scope, receive, send)
+            return
+
+        headers = [(b"access-control-allow-origin", origin), (b"vary", b"Origin")]
+        headers.extend(CORS_HEADERS)
+
+        # Preflight: answer inline without touching the app
+        if scope["method"] == "OPTIONS" and b"access-control-request-method" in request_headers:
+            allow_headers = request_headers.get(b"access-control-request-headers", b"*")
+            await send({
+                "type": "http.response.start",
+                "status": 204,
+                "headers": headers + [(b"access-control-allow-headers", allow_headers)],
+            })
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+
+# Supported TTS languages never change at runtime; serialize the payload once
+LANGS = gtts.lang.tts_langs()
+LANGS_JSON = orjson.dumps({"langs": LANGS})
+LANGS_HEADERS = {"Cache-Control": "public, max-age=86400"}
+
+# Finished audiobooks are kept by content key; only the most recent ones survive
+AUDIO_CACHE_MAX_FILES = int(os.getenv("AUDIO_CACHE_MAX_FILES", "20"))
+AUDIO_CACHE_HEADERS = {"Cache-Control": "public, max-age=86400"}
+
+# Server-sent answers must reach the client token by token, not after proxy buffering
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# Document parsing holds the GIL, so it runs in worker processes
+INGEST_PROCESSES = int(os.getenv("INGEST_PROCESSES", "2"))
+
+
+def _new_proc_pool() -> ProcessPoolExecutor:
+    """A fresh ingest pool; workers log straight to stderr."""
+    return ProcessPoolExecutor(max_workers=INGEST_PROCESSES, initializer=_init_worker_logging)
+
+
+PROC_POOL = _new_proc_pool()
+PROC_POOL_LOCK = RLock()
+
+
+async def parse_document(filepath):
+    """Run load_document in the ingest pool, replacing the pool if a worker died.
+
+    A worker killed mid-parse (a parser segfault, the OOM killer) breaks the whole
+    executor. The broken pool is swapped for a fresh one and the parse is retried
+    once; if it breaks again only this request fails.
+    """
+    global PROC_POOL
+    loop = asyncio.get_running_loop()
+    for attempt in range(2):
+        pool = PROC_POOL
+        try:
+            return await loop.run_in_executor(pool, load_document, filepath)
+        except BrokenProcessPool:
+            logger.error("❌ Ingest worker died while parsing %s; restarting the pool", filepath)
+            with PROC_POOL_LOCK:
+                if PROC_POOL is pool:
+                    PROC_POOL = _new_proc_pool()
+            pool.shutdown(wait=False, cancel_futures=True)
+    return []
+
+# Uploads are streamed to disk in 1 MiB pieces so the event loop stays free
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+# =====================================
+# SEMANTIC ANSWER CACHE
+# =====================================
+# Cosine similarity at which a new question reuses a previous answer
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))
+# Seconds a cached answer stays servable
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))
+# Per document; when full, expired rows go first, then the oldest quarter
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "5000"))
+
+
+class SemanticCache:
+    """Serve stored answers for questions whose embedding is close to a past one.
+
+    Small caches use a NumPy matvec; past ``faiss_min_entries`` the vectors move
+    into a FAISS IndexFlatIP (when faiss is installed) for SIMD inner-product search.
+    Answers older than ``ttl`` seconds are misses; the next answer for that
+    question replaces the stale one in place, so the index never holds both.
+    Once ``max_entries`` is reached the vectors are rebuilt without expired
+    rows (and, if that isn't enough, without the oldest quarter).
+    """
+
+    def __init__(self, similarity_threshold=None, faiss_min_entries=1000, ttl=None, max_entries=None):
+        if similarity_threshold is None:
+            similarity_threshold = SEMANTIC_CACHE_THRESHOLD
+        self.similarity_threshold = similarity_threshold
+        self.faiss_min_entries = faiss_min_entries
+        self.ttl = SEMANTIC_CACHE_TTL if ttl is None else ttl
+        self.max_entries = SEMANTIC_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.embeddings = None  # float32 matrix of L2-normalized question vectors
+        self.index = None
+        self.answers = []
+        self.added_at = []
+
+    @staticmethod
+    def _normalize(vector):
+        vec = np.asarray(vector, dtype=np.float32).reshape(1, -1)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def _match(self, query):
+        """Index of the nearest stored question above the threshold, or None."""
+        if self.index is not None:
+            scores, ids = self.index.search(query, 1)
+            best, score = int(ids[0][0]), scores[0][0]
+        elif self.embeddings is not None:
+            # Rows are pre-normalized, so a single BLAS matvec yields cosine similarities
+            scores = np.dot(self.embeddings, query[0])
+            best = int(np.argmax(scores))
+            score = scores[best]
+        else:
+            return None
+        return best if best >= 0 and score >= self.similarity_threshold else None
+
+    def lookup(self, vector):
+        """Return the cached answer for the nearest question, or None below threshold or expired."""
+        best = self._match(self._normalize(vector))
+        if best is None or time.monotonic() - self.added_at[best] > self.ttl:
+            return None
+        return self.answers[best]
+
+    def add(self, vector, answer):
+        row = self._normalize(vector)
+        now = time.monotonic()
+        best = self._match(row)
+        if best is not None:
+            # Refresh the expired entry rather than shadow it with a near-duplicate
+            self.answers[best] = answer
+            self.added_at[best] = now
+            return
+
+        if len(self.answers) >= self.max_entries:
+            self._evict(now)
+
+        self.answers.append(answer)
+        self.added_at.append(now)
+        if self.index is not None:
+            self.index.add(row)
+            return
+
+        self.embeddings = row if self.embeddings is None else np.vstack([self.embeddings, row])
+        if faiss is not None and len(self.answers) >= self.faiss_min_entries:
+            self._rebuild(self.embeddings)
+
+    def _evict(self, now):
+        """Drop expired rows, then the oldest ones if the cache is still full."""
+        keep = [i for i, added in enumerate(self.added_at) if now - added <= self.ttl]
+        if len(keep) >= self.max_entries:
+            # Refreshed rows are re-stamped in place, so rank by age rather than position
+            newest = sorted(keep, key=self.added_at.__getitem__)[len(keep) - self.max_entries * 3 // 4:]
+            keep = sorted(newest)
+        vectors = self.index.reconstruct_n(0, self.index.ntotal) if self.index is not None else self.embeddings
+        self.answers = [self.answers[i] for i in keep]
+        self.added_at = [self.added_at[i] for i in keep]
+        self._rebuild(vectors[keep] if keep else None)
+
+    def _rebuild(self, vectors):
+        """Hold ``vectors`` as a NumPy matrix, or in FAISS past ``faiss_min_entries``."""
+        self.index = None
+        self.embeddings = vectors
+        if vectors is not None and faiss is not None and len(vectors) >= self.faiss_min_entries:
+            self.index = faiss.IndexFlatIP(vectors.shape[1])
+            self.index.add(vectors)
+            self.embeddings = None
+
+
+# =====================================
+# EXACT ANSWER CACHE
+# =====================================
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "900"))
+
+
+class ExactAnswerCache:
+    """Redis cache of answers to verbatim repeat questions, checked before embedding.
+
+    Keys are ``ans:<doc_id>:<blake2b(question)>``. doc_id is the document's content
+    hash, so a key can't outlive the text it answers; the TTL only bounds staleness
+    of the model's wording. Redis errors are logged and treated as misses.
+    """
+
+    def __init__(self, url=None, ttl=ANSWER_CACHE_TTL):
+        self.client = aioredis.from_url(url) if aioredis is not None and url else None
+        self.ttl = ttl
+        self._pending = set()
+
+    @staticmethod
+    def key(doc_id, question):
+        digest = hashlib.blake2b(question.encode(), digest_size=16).hexdigest()
+        return f"ans:{doc_id}:{digest}"
+
+    async def get(self, doc_id, question):
+        if self.client is None:
+            return None
+        try:
+            hit = await self.client.get(self.key(doc_id, question))
+        except Exception as e:
+            logger.warning("⚠️ Redis lookup failed: %s", e)
+            return None
+        return hit.decode() if hit is not None else None
+
+    def put(self, doc_id, question, answer):
+        """Store an answer in the background; callers don't wait on Redis."""
+        if self.client is None:
+            return
+        task = asyncio.get_running_loop().create_task(self._put(doc_id, question, answer))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _put(self, doc_id, question, answer):
+        try:
+            await self.client.setex(self.key(doc_id, question), self.ttl, answer)
+        except Exception as e:
+            logger.warning("⚠️ Redis store failed: %s", e)
+
+    async def close(self):
+        if self.client is None:
+            return
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        await self.client.aclose()
+
+
+exact_cache = ExactAnswerCache(os.getenv("REDIS_URL"))
+
+
+# =====================================
+# ANSWER MICRO-BATCHER
+# =====================================
+ANSWER_BATCHING = os.getenv("ANSWER_BATCHING", "1") == "1"
+
+
+class AnswerBatcher:
+    """Coalesce concurrent /api/answer calls into rag_chain.abatch() calls."""
+
+    def __init__(self, max_size=16, max_wait=0.01):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.queue = None
+        self._task = None
+        self._inflight = set()
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def submit(self, chain, question):
+        """Queue a question for its chain and wait for the raw chain response."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((chain, question, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(items) < self.max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Sessions own separate chains, so one batch per chain
+            groups = {}
+            for chain, question, future in items:
+                groups.setdefault(id(chain), (chain, []))[1].append((question, future))
+            for chain, pending in groups.values():
+                task = asyncio.create_task(self._dispatch(chain, pending))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, chain, pending):
+        try:
+            results = await chain.abatch(
+                [{"query": question} for question, _ in pending], return_exceptions=True
+            )
+        except Exception as e:
+            results = [e] * len(pending)
+
+        for (_, future), result in zip(pending, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+answer_batcher = AnswerBatcher()
+
+
+# =====================================
+# HISTORY PERSISTENCE
+# =====================================
+HISTORY_FLUSH_INTERVAL = 5.0
+
+
+class HistoryFlusher:
+    """Write Q&A history files in the background, at most once per interval.
+
+    /api/answer only marks a history dirty; repeated answers within the interval
+    collapse into a single write done off the event loop.
+    """
+
+    def __init__(self, interval=HISTORY_FLUSH_INTERVAL):
+        self.interval = interval
+        self.dirty = None
+        self.pending = {}
+        self._task = None
+
+    def start(self):
+        self.dirty = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+
+    def mark(self, vector_store, filename):
+        """Schedule a write of this vector store's history."""
+        if self._task is None:
+            # No background task (e.g. app used without lifespan): write now
+            persist_qa_history(vector_store, filename)
+            return
+        self.pending[id(vector_store)] = (vector_store, filename)
+        self.dirty.set()
+
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        for vector_store, filename in pending.values():
+            await asyncio.to_thread(persist_qa_history, vector_store, filename)
+
+    async def _run(self):
+        while True:
+            await self.dirty.wait()
+            await asyncio.sleep(self.interval)
+            self.dirty.clear()
+            await self.flush()
+
+
+history_flusher = HistoryFlusher()
+
+
 # =====================================
 # GLOBAL STATE
 # =====================================
-STATE = {
-    "uploaded_filename": None,
-    "uploaded_filepath": None,
-    "vector_store": None,
-    "rag_chain": None,
-    "user_logged_in": False,
-    "auth_token": None,
-    "qa_history": []
-}
+# Only the most recent Q&A pairs are kept per session
+QA_HISTORY_LIMIT = 200
+
+
+@dataclass(slots=True)
+class DocIndex:
+    """An indexed document: its vector store, RAG chain and answer cache.
+
+    Shared by every session that uploaded the same bytes; ``_lock`` guards the
+    answer cache and the lazily filled ``raw_text``.
+    """
+
+    doc_id: str
+    filename: str
+    filepath: str
+    vector_store: Any
+    rag_chain: Any
+    raw_text: Optional[str] = None
+    answer_cache: SemanticCache = field(default_factory=SemanticCache)
+    _lock: RLock = field(default_factory=RLock, repr=False)
+
+
+@dataclass(slots=True)
+class AppState:
+    """Per-session state; slotted so field access skips the instance __dict__.
+
+    Sync routes run in the threadpool, so multi-field updates and history
+    reads/writes go through ``_lock``.
+    """
+
+    auth_token: Optional[str] = None
+    uploaded_filename: Optional[str] = None
+    uploaded_filepath: Optional[str] = None
+    doc: Optional[DocIndex] = None
+    qa_history: deque = field(default_factory=lambda: deque(maxlen=QA_HISTORY_LIMIT))
+    last_seen: float = field(default_factory=time.monotonic)
+    _lock: RLock = field(default_factory=RLock, repr=False)
+
+
+# One AppState per bearer token, least-recently-used first. Keyed by the token's
+# SHA-256 so the dict lookup never hashes or compares the raw secret
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "64"))
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(12 * 60 * 60)))  # idle seconds before a token expires
+SESSIONS: OrderedDict[str, AppState] = OrderedDict()
+SESSIONS_LOCK = RLock()
+
+
+def _expire_sessions(now):
+    """Drop idle sessions; the map is in recency order, so stop at the first live one."""
+    while SESSIONS:
+        oldest = next(iter(SESSIONS.values()))
+        if now - oldest.last_seen <= SESSION_TTL:
+            break
+        SESSIONS.popitem(last=False)
+
+
+def session_key(token: str) -> str:
+    """The SESSIONS key for a bearer token."""
+    return hashlib.sha256(token.encode("latin-1")).hexdigest()
+
+
+def open_session(token: str) -> AppState:
+    """Register a fresh session, evicting expired and least recently used ones."""
+    session = AppState(auth_token=token)
+    with SESSIONS_LOCK:
+        _expire_sessions(session.last_seen)
+        SESSIONS[session_key(token)] = session
+        while len(SESSIONS) > MAX_SESSIONS:
+            SESSIONS.popitem(last=False)
+    return session
+
+
+def touch_session(token: str) -> Optional[AppState]:
+    """Return the live session for a token and mark it as just used."""
+    now = time.monotonic()
+    key = session_key(token)
+    with SESSIONS_LOCK:
+        session = SESSIONS.get(key)
+        if session is None or not hmac.compare_digest(
+            token.encode("latin-1"), session.auth_token.encode("latin-1")
+        ):
+            return None
+        if now - session.last_seen > SESSION_TTL:
+            del SESSIONS[key]
+            return None
+        session.last_seen = now
+        SESSIONS.move_to_end(key)
+        return session
+
+# Indexed documents by content hash, least-recently-used first, so re-uploads
+# and other sessions skip parsing, embedding and chain construction
+CHAIN_POOL_SIZE = int(os.getenv("CHAIN_POOL_SIZE", "8"))
+CHAINS: OrderedDict[str, DocIndex] = OrderedDict()
+CHAINS_LOCK = RLock()
+
+
+def pooled_index(doc_id: str) -> Optional[DocIndex]:
+    """Return the indexed document for ``doc_id`` and mark it as just used."""
+    with CHAINS_LOCK:
+        index = CHAINS.get(doc_id)
+        if index is not None:
+            CHAINS.move_to_end(doc_id)
+        return index
+
+
+def pool_index(index: DocIndex) -> DocIndex:
+    """Add an indexed document, keeping the one already pooled if another request won."""
+    with CHAINS_LOCK:
+        index = CHAINS.setdefault(index.doc_id, index)
+        CHAINS.move_to_end(index.doc_id)
+        while len(CHAINS) > CHAIN_POOL_SIZE:
+            CHAINS.popitem(last=False)
+    return index
+
 
 # =====================================
 # MODELS
@@ -54,28 +674,175 @@ class LoginPayload(BaseModel):
 
 class QuestionPayload(BaseModel):
     question: str
+    stream: bool = False
+    doc_id: Optional[str] = None
 
 class AudiobookPayload(BaseModel):
     lang_code: Optional[str] = "en"
 
 # =====================================
-# AUTH DEPENDENCY
+# AUTH MIDDLEWARE
+# =====================================
+# Routes under /api/ that don't need a bearer token
+AUTH_EXEMPT_PATHS = frozenset({"/api/login", "/api/langs"})
+
+# Prebuilt 401 bodies for the auth hot path
+_E_MISS = orjson.dumps({"detail": "Missing authorization header"})
+_E_FMT = orjson.dumps({"detail": "Invalid authorization header format"})
+_E_UNAUTH = orjson.dumps({"detail": "Unauthorized. Please log in first."})
+
+
+class BearerAuthMiddleware:
+    """Pure ASGI bearer check for a path prefix; stores the caller's AppState in scope["user"]."""
+
+    def __init__(self, app, prefix="/api/", exempt=AUTH_EXEMPT_PATHS):
+        self.app = app
+        self.prefix = prefix
+        self.exempt = exempt
+
+    @staticmethod
+    async def _reject(send, body):
+        await send({
+            "type": "http.response.start",
+            "status": 401,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not scope["path"].startswith(self.prefix)
+            or scope["path"] in self.exempt
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        # ASGI header names are already lowercased bytes
+        authorization = None
+        for key, value in scope["headers"]:
+            if key == b"authorization":
+                authorization = value
+                break
+
+        if not authorization:
+            await self._reject(send, _E_MISS)
+            return
+
+        if authorization[:7].lower() != b"bearer ":
+            await self._reject(send, _E_FMT)
+            return
+
+        token = authorization[7:].strip().decode("latin-1")
+        session = touch_session(token)
+        if session is None:
+            await self._reject(send, _E_UNAUTH)
+            return
+
+        scope["user"] = session
+        await self.app(scope, receive, send)
+
+
+# =====================================
+# MIDDLEWARE STACK
+# =====================================
+# Last added is outermost: CORS answers preflights first, compression and auth run inside it
+app.add_middleware(BearerAuthMiddleware, prefix="/api/", exempt=AUTH_EXEMPT_PATHS)
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
+app.add_middleware(CORS, origins=["*"])  # For dev; restrict in production
+
+# =====================================
+# UPLOAD HELPERS
+# =====================================
+def _sendfile_copy(src_fd, dst_path):
+    """Copy a whole file descriptor to dst_path inside the kernel."""
+    size = os.fstat(src_fd).st_size
+    with open(dst_path, "wb") as out:
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(out.fileno(), src_fd, offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+
+
+async def save_upload(file: UploadFile, dst_path):
+    """Write an upload to disk without blocking the event loop.
+
+    Bodies Starlette already spooled to a temp file (over 1 MB) are copied with
+    os.sendfile on Linux; smaller in-memory bodies are streamed with aiofiles.
+    """
+    spooled = file.file
+    # fileno() would force an in-memory spool to disk, so check _rolled first
+    if sys.platform.startswith("linux") and getattr(spooled, "_rolled", False):
+        await anyio.to_thread.run_sync(_sendfile_copy, spooled.fileno(), dst_path)
+        return
+
+    async with aiofiles.open(dst_path, "wb") as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            await f.write(chunk)
+
+
+def file_sha256(path):
+    """Hex SHA-256 of a file's contents, read in upload-sized chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# =====================================
+# DOCUMENT TEXT
 # =====================================
-def require_login(authorization: Optional[str] = Header(None)):
-    """Check Bearer token before allowing access."""
-    if not authorization:
-        raise HTTPException(status_code=401, detail="Missing authorization header")
+def document_text(docs):
+    """Join page contents with blank lines, without building an intermediate list."""
+    buf = io.StringIO()
+    for i, doc in enumerate(docs):
+        if i:
+            buf.write("\n\n")
+        buf.write(getattr(doc, "page_content", str(doc)))
+    return buf.getvalue()
 
-    parts = authorization.split()
-    if len(parts) != 2 or parts[0].lower() != "bearer":
-        raise HTTPException(status_code=401, detail="Invalid authorization header format")
 
-    token = parts[1]
-    if not STATE["user_logged_in"] or token != STATE["auth_token"]:
-        raise HTTPException(status_code=401, detail="Unauthorized. Please log in first.")
+# =====================================
+# AUDIO CACHE
+# =====================================
+def audio_cache_key(doc_id, lang_code):
+    """Key an audiobook by document content hash and language, whatever path it was uploaded to."""
+    return hashlib.sha1(f"{doc_id}:{lang_code}".encode()).hexdigest()
 
+
+def touch_cached_audio(path):
+    """Mark a cached MP3 as recently used; False if it isn't cached."""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
     return True
 
+
+def prune_audio_cache(cache_dir, keep):
+    """Delete all but the ``keep`` most recently used cached MP3s."""
+    files = []
+    for path in cache_dir.glob("*.mp3"):
+        try:
+            files.append((path.stat().st_mtime, path))
+        except FileNotFoundError:  # removed by a concurrent prune
+            continue
+    files.sort(reverse=True)
+    for _, stale in files[keep:]:
+        try:
+            os.remove(stale)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("⚠️ Could not remove cached audio %s: %s", stale, e)
+
+
 # =====================================
 # ROUTES
 # =====================================
@@ -89,114 +856,306 @@ def root():
 def login(payload: LoginPayload):
     """Simple fixed-credential login"""
     if payload.username == "admin" and payload.password == "password123":
-        token = uuid.uuid4().hex
-        STATE["user_logged_in"] = True
-        STATE["auth_token"] = token
+        token = secrets.token_hex(16)
+        open_session(token)
         return {"status": "ok", "token": token}
     raise HTTPException(status_code=401, detail="Invalid credentials")
 
 # ---------- Q&A HISTORY ----------
 @app.get("/api/qa-history")
-def get_qa_history(auth: bool = Depends(require_login)):
+def get_qa_history(request: Request):
     """Return stored QA history"""
-    return {"qa_pairs": STATE.get("qa_history", [])}
+    session: AppState = request.scope["user"]
+    with session._lock:
+        qa_pairs = list(session.qa_history)
+    # Returning the response directly skips FastAPI's jsonable_encoder walk over the history
+    return ORJSONResponse({"qa_pairs": qa_pairs})
 
 # ---------- UPLOAD DOCUMENT ----------
+async def build_doc_index(doc_id, filename, filepath, embedder) -> DocIndex:
+    """Index a saved upload under chroma_db/<embedding namespace>/<doc_id>, reusing vectors persisted there.
+
+    The namespace keeps indexes built by another embedding backend, model or
+    dimension setting from being reopened with vectors of the wrong width.
+    """
+    persist_directory = str(CHROMA_DIR / embedding_namespace() / doc_id)
+    raw_text = None
+    docs = None
+
+    vector_store = None
+    if os.path.isdir(persist_directory):
+        vector_store = await asyncio.to_thread(
+            create_vector_store, [], persist_directory=persist_directory, embedder=embedder
+        )
+        if vector_store is not None and vector_store_is_empty(vector_store):
+            vector_store = None
+
+    if vector_store is None:
+        # Parse in a worker process and index in a thread so other requests keep flowing.
+        # The vector store wraps a live Chroma client, so it can't come back from a process.
+        docs = await parse_document(filepath)
+        if not docs:
+            raise HTTPException(status_code=500, detail="Failed to load document")
+
+        vector_store = await asyncio.to_thread(
+            create_vector_store, docs, persist_directory=persist_directory, embedder=embedder
+        )
+        # Keep the joined text so /api/audiobook doesn't parse the file a second time
+        raw_text = document_text(docs)
+
+    rag_chain = await asyncio.to_thread(create_rag_chain, vector_store, docs)
+    if rag_chain is None:
+        raise HTTPException(status_code=500, detail="Failed to build RAG chain")
+    return DocIndex(
+        doc_id=doc_id,
+        filename=filename,
+        filepath=filepath,
+        vector_store=vector_store,
+        rag_chain=rag_chain,
+        raw_text=raw_text,
+    )
+
+
 @app.post("/api/upload")
-async def upload_document(file: UploadFile = File(...), auth: bool = Depends(require_login)):
+async def upload_document(request: Request, file: UploadFile = File(...)):
     """Upload a document and create RAG chain"""
+    session: AppState = request.scope["user"]
     filename = file.filename
     ext = os.path.splitext(filename)[1].lower()
     if ext not in [".pdf", ".txt", ".docx"]:
         raise HTTPException(status_code=400, detail="Only .pdf, .txt, .docx allowed")
 
-    save_dir = os.path.join(os.path.dirname(__file__), "temp_files")
-    os.makedirs(save_dir, exist_ok=True)
-    unique_name = f"{uuid.uuid4().hex}_{filename}"
-    save_path = os.path.join(save_dir, unique_name)
-    with open(save_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    unique_name = f"{secrets.token_hex(16)}_{filename}"
+    save_path = str(TEMP_DIR / unique_name)
+    await save_upload(file, save_path)
 
-    docs = load_document(save_path)
-    if not docs:
-        raise HTTPException(status_code=500, detail="Failed to load document")
+    doc_id = await asyncio.to_thread(file_sha256, save_path)
+    index = pooled_index(doc_id)
+    if index is not None:
+        # Same bytes are already indexed; keep the first copy so audio cache keys match
+        await anyio.to_thread.run_sync(os.remove, save_path)
+    else:
+        index = pool_index(await build_doc_index(doc_id, filename, save_path, request.app.state.embedder))
 
-    vector_store = create_vector_store(
-        docs, persist_directory=os.path.join(os.path.dirname(__file__), "chroma_db")
-    )
-    rag_chain = create_rag_chain(vector_store)
+    with session._lock:
+        session.uploaded_filename = filename
+        session.uploaded_filepath = index.filepath
+        session.doc = index
 
-    STATE.update({
-        "uploaded_filename": filename,
-        "uploaded_filepath": save_path,
-        "vector_store": vector_store,
-        "rag_chain": rag_chain,
-    })
-
-    return {"status": "ok", "filename": filename}
+    return {"status": "ok", "filename": filename, "doc_id": doc_id}
 
 # ---------- ANSWER QUESTIONS ----------
 @app.post("/api/answer")
-async def get_answer(payload: QuestionPayload, auth: bool = Depends(require_login)):
+async def get_answer(request: Request, payload: QuestionPayload):
     """Ask a question using RAG"""
-    if not STATE.get("rag_chain"):
-        raise HTTPException(status_code=400, detail="No document uploaded yet")
+    session: AppState = request.scope["user"]
+    if payload.doc_id:
+        index = pooled_index(payload.doc_id)
+        if index is None:
+            raise HTTPException(status_code=404, detail="Unknown doc_id; upload the document again")
+    else:
+        index = session.doc
+        if index is None:
+            raise HTTPException(status_code=400, detail="No document uploaded yet")
 
     question = payload.question
-    chain = STATE["rag_chain"]
+    chain = index.rag_chain
 
     try:
-        print(f"🧠 /api/answer request: {question}")
-        response = chain.invoke({"query": question})
+        logger.info("🧠 /api/answer request: %s", question)
+
+        exact = await exact_cache.get(index.doc_id, question)
+        if exact is not None:
+            logger.info("⚡ Exact answer cache hit")
+            with session._lock:
+                session.qa_history.append([question, exact])
+            return cached_answer_response(exact, payload.stream)
+
+        # Embed with the vector store's own model so cache and retrieval agree
+        try:
+            question_vector = await index.vector_store.embeddings.aembed_query(question)
+        except Exception as e:
+            logger.warning("⚠️ Question embedding failed, skipping cache: %s", e)
+            question_vector = None
+
+        if question_vector is not None:
+            with index._lock:
+                cached = index.answer_cache.lookup(question_vector)
+            if cached is not None:
+                logger.info("⚡ Semantic cache hit")
+                with session._lock:
+                    session.qa_history.append([question, cached])
+                return cached_answer_response(cached, payload.stream)
+
+        if payload.stream:
+            return StreamingResponse(
+                stream_answer(session, index, question, question_vector),
+                media_type="text/event-stream",
+                headers=SSE_HEADERS,
+            )
+
+        if answer_batcher.running:
+            response = await answer_batcher.submit(chain, question)
+        else:
+            response = await chain.ainvoke({"query": question})
         answer = response.get("result") or response.get("answer") or str(response)
+        record_answer(session, index, question, answer, question_vector)
 
+        return ORJSONResponse({"answer": answer})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error getting answer: {e}")
+
+def record_answer(session: AppState, index: DocIndex, question, answer, question_vector=None):
+    """Cache an answer, add it to the session history and queue it for persistence."""
+    if question_vector is not None:
+        with index._lock:
+            index.answer_cache.add(question_vector, answer)
+    exact_cache.put(index.doc_id, question, answer)
+    with session._lock:
         # Save to history
-        STATE["qa_history"].append([question, answer])
+        session.qa_history.append([question, answer])
+
+    # Store in RAG vector store; the file write is debounced in the background
+    store_rag_answer(index.vector_store, answer, question, index.filename, persist=False)
+    history_flusher.mark(index.vector_store, index.filename)
+
 
-        # Store in RAG vector store
-        store_rag_answer(
-            STATE["vector_store"], answer, question, STATE["uploaded_filename"]
+def sse_event(data, event=None):
+    """Encode one server-sent event; JSON keeps newlines in tokens off the wire."""
+    head = f"event: {event}\n".encode() if event else b""
+    return head + b"data: " + orjson.dumps(data) + b"\n\n"
+
+
+def cached_answer_response(answer, stream):
+    """Reply with a cached answer as JSON, or as a one-token event stream."""
+    if stream:
+        return StreamingResponse(
+            iter([sse_event({"token": answer}), sse_event({"answer": answer, "cached": True}, event="done")]),
+            media_type="text/event-stream",
+            headers=SSE_HEADERS,
         )
+    return ORJSONResponse({"answer": answer, "cached": True})
+
 
-        return {"answer": answer}
+async def stream_answer(session: AppState, index: DocIndex, question, question_vector):
+    """Yield LLM tokens as SSE while the chain runs, then a final ``done`` event.
+
+    RetrievalQA only streams its final dict, so tokens are taken from the LLM's
+    stream events. Only a completed answer is cached and persisted; if the chain
+    fails or the client disconnects mid-stream, the partial text goes to the
+    session history alone.
+    """
+    parts = []
+    answer = None
+    completed = False
+    try:
+        async for event in index.rag_chain.astream_events({"query": question}, version="v2"):
+            kind = event["event"]
+            if kind == "on_llm_stream":
+                chunk = event["data"]["chunk"]
+                token = getattr(chunk, "text", None) or getattr(chunk, "content", "")
+                if token:
+                    parts.append(token)
+                    yield sse_event({"token": token})
+            elif kind == "on_chain_end" and not event["parent_ids"]:
+                output = event["data"].get("output") or {}
+                answer = output.get("result") or output.get("answer")
+        answer = answer or "".join(parts)
+        completed = True
+        # Recorded before the final event so a disconnect now can't lose it
+        record_answer(session, index, question, answer, question_vector)
+        yield sse_event({"answer": answer}, event="done")
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error getting answer: {e}")
+        logger.error("❌ Streaming answer failed: %s", e)
+        yield sse_event({"detail": f"Error getting answer: {e}"}, event="error")
+    finally:
+        if not completed and parts:
+            with session._lock:
+                session.qa_history.append([question, "".join(parts)])
+
 
 # ---------- AUDIOBOOK GENERATION ----------
 @app.post("/api/audiobook")
-async def generate_audiobook(payload: AudiobookPayload, auth: bool = Depends(require_login)):
+async def generate_audiobook(request: Request, payload: AudiobookPayload):
     """Convert uploaded text into audio"""
-    if not STATE.get("uploaded_filepath"):
+    session: AppState = request.scope["user"]
+    index = session.doc
+    if index is None:
         raise HTTPException(status_code=400, detail="No document uploaded yet")
 
     lang_code = payload.lang_code or "en"
-    try:
-        docs = load_document(STATE["uploaded_filepath"])
-        raw_text = "\n\n".join([getattr(d, "page_content", str(d)) for d in docs])
-
-        save_dir = os.path.join(os.path.dirname(__file__), "temp_files")
-        os.makedirs(save_dir, exist_ok=True)
-
-        base_name = os.path.splitext(STATE["uploaded_filename"])[0]
-        audio_filename = f"{base_name}_audiobook.mp3"
-        audio_path = os.path.join(save_dir, audio_filename)
-
-        audio_path = convert_text_to_audio(
-            raw_text, output_filename=audio_path, lang_code=lang_code
+    if lang_code not in LANGS:
+        raise HTTPException(status_code=400, detail=f"Language not supported: {lang_code}")
+
+    base_name = os.path.splitext(session.uploaded_filename)[0]
+    audio_filename = f"{base_name}_audiobook.mp3"
+    key = audio_cache_key(index.doc_id, lang_code)
+    audio_path = AUDIO_CACHE_DIR / f"{key}.mp3"
+    cache_headers = {**AUDIO_CACHE_HEADERS, "ETag": f'"{key}"'}
+
+    # Cache probe and pruning touch the disk, so they run off the event loop
+    if await anyio.to_thread.run_sync(touch_cached_audio, audio_path):
+        return FileResponse(
+            audio_path,
+            media_type="audio/mpeg",
+            filename=audio_filename,
+            headers={**cache_headers, "Content-Encoding": "identity", "Accept-Ranges": "bytes"},
         )
 
-        if not audio_path or not os.path.exists(audio_path):
-            raise HTTPException(status_code=500, detail="Audio generation failed")
-
-        return FileResponse(audio_path, media_type="audio/mpeg", filename=audio_filename)
+    raw_text = index.raw_text
+    if raw_text is None:
+        docs = await parse_document(index.filepath)
+        if not docs:
+            raise HTTPException(status_code=500, detail="Failed to load document")
+        raw_text = document_text(docs)
+        with index._lock:
+            index.raw_text = raw_text
+
+    # Make room for the file this request is about to add
+    await anyio.to_thread.run_sync(prune_audio_cache, AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_FILES - 1)
+
+    # Stream audio as chunks finish so playback can start before synthesis ends;
+    # the complete file is saved under its cache key for the next request. The
+    # generator is sync, so Starlette advances it (and its file writes) in a thread
+    audio = stream_text_to_audio(raw_text, lang_code=lang_code, output_filename=audio_path)
+    # The first chunk is pulled before the 200 goes out, so a failing Gemini or
+    # gTTS call still reaches the client as an error rather than a cut-off file
+    try:
+        first = await anyio.to_thread.run_sync(next, audio, None)
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Audio generation error: {e}")
+        logger.error("❌ Audio generation failed: %s", e)
+        raise HTTPException(status_code=500, detail="Audio generation failed")
+    if first is None:
+        raise HTTPException(status_code=500, detail="Audio generation failed")
+
+    return StreamingResponse(
+        itertools.chain([first], audio),
+        media_type="audio/mpeg",
+        headers={
+            **cache_headers,
+            "Content-Disposition": f"attachment; filename*=utf-8''{quote(audio_filename)}",
+            "Content-Encoding": "identity",
+        },
+    )
 
 # ---------- LANGUAGES ----------
 @app.get("/api/langs")
 def list_languages():
     """List supported TTS languages"""
-    return {"langs": gtts.lang.tts_langs()}
+    return Response(content=LANGS_JSON, media_type="application/json", headers=LANGS_HEADERS)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "backend.app:app",
+        host=os.getenv("HOST", "127.0.0.1"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="uvloop" if uvloop is not None else "asyncio",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+    )
 
 
 # import os
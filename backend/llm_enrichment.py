@@ -1,5 +1,83 @@
 import google.generativeai as genai
 import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+logger = logging.getLogger(__name__)
+
+# ~1500 tokens per request keeps each call well inside limits and quick to return
+ENRICH_CHUNK_CHARS = 6000
+ENRICH_CONCURRENCY = int(os.getenv("ENRICH_CONCURRENCY", "8"))
+# The opening piece is kept short so the first audio can start after one quick call
+ENRICH_FIRST_CHUNK_CHARS = 1000
+ENRICH_SPLITTER = RecursiveCharacterTextSplitter(chunk_size=ENRICH_CHUNK_CHARS, chunk_overlap=0)
+FIRST_CHUNK_SPLITTER = RecursiveCharacterTextSplitter(chunk_size=ENRICH_FIRST_CHUNK_CHARS, chunk_overlap=0)
+
+ENRICH_PROMPT = (
+    "Rewrite the following text in {lang} for an engaging audiobook narration. "
+    "Make it clear, expressive, and conversational. Keep the language strictly {lang}:\n\n"
+)
+
+# Plain text, single candidate: no JSON mode and no alternates to generate
+GENERATION_CONFIG = genai.GenerationConfig(response_mime_type="text/plain", candidate_count=1)
+
+@lru_cache(maxsize=1)
+def get_gemini_model():
+    """The Gemini model client, configured and created once and shared across calls."""
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    return genai.GenerativeModel("gemini-2.5-flash-preview-05-20", generation_config=GENERATION_CONFIG)
+
+@lru_cache(maxsize=None)
+def enrich_prompt(lang_code):
+    """The instruction prefix for a language, formatted once per lang_code."""
+    return ENRICH_PROMPT.format(lang=lang_code)
+
+def _enrich_chunk(model, chunk, lang_code):
+    """Rewrites one chunk, returning it unchanged if the call fails."""
+    try:
+        response = model.generate_content(enrich_prompt(lang_code) + chunk)
+
+        if response.candidates and response.candidates[0].content.parts:
+            return response.candidates[0].content.parts[0].text
+        return chunk
+
+    except Exception as e:
+        logger.error("An error occurred during LLM enrichment: %s", e)
+        return chunk
+
+def split_for_enrichment(text):
+    """Splits text into Gemini-sized pieces, with a short lead piece."""
+    chunks = ENRICH_SPLITTER.split_text(text) or [text]
+    head = FIRST_CHUNK_SPLITTER.split_text(chunks[0])
+    if len(head) > 1:
+        chunks[:1] = [head[0], "\n".join(head[1:])]
+    return chunks
+
+def enrich_chunks(text, lang_code="en"):
+    """
+    Yields the enriched text piece by piece, in order. Pieces are rewritten
+    concurrently (up to ENRICH_CONCURRENCY Gemini calls in flight), so callers
+    can start on the first one while later ones are still being generated.
+    """
+    if not os.getenv("GOOGLE_API_KEY"):
+        logger.warning("API key not found. Please set the GOOGLE_API_KEY environment variable.")
+        yield text
+        return
+
+    model = get_gemini_model()
+
+    chunks = split_for_enrichment(text)
+    if len(chunks) == 1:
+        yield _enrich_chunk(model, chunks[0], lang_code)
+        return
+
+    pool = ThreadPoolExecutor(max_workers=min(ENRICH_CONCURRENCY, len(chunks)))
+    try:
+        yield from pool.map(lambda chunk: _enrich_chunk(model, chunk, lang_code), chunks)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
 
 def enrich_text_with_llm(text, lang_code="en"):
     """
@@ -10,24 +88,4 @@ def enrich_text_with_llm(text, lang_code="en"):
         text (str): The text to enrich.
         lang_code (str): Target language (default: 'en').
     """
-    if not os.getenv("GOOGLE_API_KEY"):
-        print("API key not found. Please set the GOOGLE_API_KEY environment variable.")
-        return text 
-
-    try:
-        genai.api_key = os.getenv("GOOGLE_API_KEY")
-        model_name = "gemini-2.5-flash-preview-05-20"
-        model = genai.GenerativeModel(model_name)
-
-        response = model.generate_content(
-            f"Rewrite the following text in {lang_code} for an engaging audiobook narration. "
-            f"Make it clear, expressive, and conversational. Keep the language strictly {lang_code}:\n\n{text}"
-        )
-
-        if response.candidates and response.candidates[0].content.parts:
-            return response.candidates[0].content.parts[0].text
-        return text
-
-    except Exception as e:
-        print(f"An error occurred during LLM enrichment: {e}")
-        return text
\ No newline at end of file
+    return "\n\n".join(enrich_chunks(text, lang_code=lang_code))
\ No newline at end of file
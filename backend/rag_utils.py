@@ -1,92 +1,431 @@
 import os
-import json
+import re
+import mmap
+import logging
+import numpy as np
+import orjson
+import requests
+import PyPDF2
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
 from langchain_community.document_loaders import (
+    PyMuPDFLoader,
     PyPDFLoader,
     TextLoader,
     UnstructuredWordDocumentLoader,
 )
-from langchain_community.embeddings import OllamaEmbeddings
+from langchain_community.embeddings import (
+    FastEmbedEmbeddings,
+    HuggingFaceEmbeddings,
+    InfinityEmbeddings,
+    OllamaEmbeddings,
+)
 from langchain_community.llms import Ollama
-from langchain_community.vectorstores import Chroma
+from langchain_community.vectorstores import FAISS, Chroma
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain.chains import RetrievalQA
+from langchain.retrievers import EnsembleRetriever
+from langchain_community.retrievers import BM25Retriever
+from langchain_core.documents import Document
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain.storage import LocalFileStore
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+try:
+    import pymupdf  # noqa: F401  (backs PyMuPDFLoader)
+    PYMUPDF_AVAILABLE = True
+except ImportError:
+    PYMUPDF_AVAILABLE = False
+
+try:
+    import rank_bm25  # noqa: F401  (backs BM25Retriever)
+    BM25_AVAILABLE = True
+except ImportError:
+    BM25_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
 # ------------------------------------
 # Document Loader
 # ------------------------------------
+# Stateless, so one splitter serves every load (and every worker process)
+TEXT_SPLITTER = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+
+
+# Above this size the pypdf fallback would read the whole file into RAM; map it instead
+MMAP_MIN_BYTES = 32 * 1024 * 1024
+
+
+def _load_pdf_mmap(file_path: str):
+    """One Document per page, parsed from a read-only mmap so pages fault in on demand."""
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        reader = PyPDF2.PdfReader(mm)
+        return [
+            Document(page_content=page.extract_text() or "", metadata={"source": file_path, "page": i})
+            for i, page in enumerate(reader.pages)
+        ]
+
+
 def load_document(file_path: str):
     """Load documents from PDF, TXT, or DOCX."""
     ext = os.path.splitext(file_path)[1].lower()
     try:
         if ext == ".pdf":
-            print(f"📘 Loading PDF: {file_path}")
-            loader = PyPDFLoader(file_path)
+            logger.info("📘 Loading PDF: %s", file_path)
+            # MuPDF's C parser is far faster than pypdf's pure-Python one, and reads
+            # pages from the file lazily rather than loading it whole
+            if PYMUPDF_AVAILABLE:
+                loader = PyMuPDFLoader(file_path)
+            elif os.path.getsize(file_path) > MMAP_MIN_BYTES:
+                loader = None
+            else:
+                loader = PyPDFLoader(file_path)
         elif ext == ".txt":
-            print(f"📄 Loading TXT: {file_path}")
+            logger.info("📄 Loading TXT: %s", file_path)
             loader = TextLoader(file_path)
         elif ext == ".docx":
-            print(f"📝 Loading DOCX: {file_path}")
+            logger.info("📝 Loading DOCX: %s", file_path)
             loader = UnstructuredWordDocumentLoader(file_path)
         else:
             raise ValueError(f"Unsupported file type: {ext}")
 
-        docs = loader.load()
+        docs = loader.load() if loader is not None else _load_pdf_mmap(file_path)
 
         # Split into chunks for embedding
-        splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        chunks = splitter.split_documents(docs)
-        print(f"✅ Loaded {len(chunks)} chunks.")
+        chunks = TEXT_SPLITTER.split_documents(docs)
+        logger.info("✅ Loaded %d chunks.", len(chunks))
         return chunks
     except Exception as e:
-        print(f"❌ Document loading failed: {e}")
+        logger.error("❌ Document loading failed: %s", e)
         return []
 
 
+# ------------------------------------
+# Embedding Model
+# ------------------------------------
+EMBED_BATCH_SIZE = 64
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "8"))
+# nomic-embed-text is Matryoshka-trained, so a prefix of its 768 dims is itself an embedding
+EMBED_DIMENSIONS = int(os.getenv("EMBED_DIMENSIONS", "0")) or None
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "ollama")
+ONNX_EMBED_MODEL = os.getenv("ONNX_EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+ONNX_EMBED_FILE = os.getenv("ONNX_EMBED_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+INFINITY_URL = os.getenv("INFINITY_URL", "http://localhost:7997")
+INFINITY_EMBED_MODEL = os.getenv("INFINITY_EMBED_MODEL", "nomic-ai/nomic-embed-text-v1.5")
+FASTEMBED_MODEL = os.getenv("FASTEMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# Chunk vectors are cached on disk by content hash; set EMBED_CACHE_DIR="" to disable
+OLLAMA_EMBED_MODEL = "nomic-embed-text"
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", os.path.join(os.path.dirname(__file__), "emb_cache"))
+
+
+# One keep-alive connection pool for all embedding requests, sized for the concurrent batches
+_http = requests.Session()
+_http.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=max(EMBED_WORKERS, 32)))
+_http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=max(EMBED_WORKERS, 32)))
+
+
+class BatchedOllamaEmbeddings(OllamaEmbeddings):
+    """OllamaEmbeddings that embeds many texts per request via Ollama's /api/embed.
+
+    The stock class posts one text at a time to /api/embeddings. Here texts are
+    sorted by length and sent in batches, so the model runs one padded forward
+    pass per batch, and batches are sent concurrently since each request mostly
+    waits on the server. Queries use the same endpoint, keeping all vectors
+    L2-normalized the same way. Servers without /api/embed fall back to the
+    per-text path, whose raw vectors are normalized here to match. With
+    ``dimensions`` set, vectors are layer-normed, cut to that many leading dims
+    and re-normalized, shrinking what Chroma stores and compares.
+    """
+
+    batch_size: int = EMBED_BATCH_SIZE
+    max_workers: int = EMBED_WORKERS
+    dimensions: Optional[int] = EMBED_DIMENSIONS
+    batch_endpoint_available: bool = True
+
+    def _truncate(self, vectors):
+        if not self.dimensions or not vectors:
+            return vectors
+        # nomic-embed-text's Matryoshka recipe: layer norm over the full vector, then
+        # slice, then L2-normalize. Layer norm is scale-invariant, so it can run on
+        # the already-normalized vectors Ollama returns.
+        matrix = np.asarray(vectors, dtype=np.float32)
+        matrix = (matrix - matrix.mean(axis=1, keepdims=True)) / np.sqrt(matrix.var(axis=1, keepdims=True) + 1e-5)
+        return self._normalize(matrix[:, :self.dimensions])
+
+    def _embed_batch(self, inputs):
+        res = _http.post(
+            f"{self.base_url}/api/embed",
+            headers={"Content-Type": "application/json", **(self.headers or {})},
+            json={"input": inputs, **self._default_params},
+        )
+        if res.status_code == 404:
+            # /api/embed also 404s for a model that isn't pulled yet; that's not a
+            # reason to give up on the endpoint for the rest of the process
+            if "not found" in res.text and "model" in res.text:
+                raise ValueError(f"Error raised by inference API HTTP code: 404, {res.text}")
+            self.batch_endpoint_available = False
+            return None
+        if res.status_code != 200:
+            raise ValueError(f"Error raised by inference API HTTP code: {res.status_code}, {res.text}")
+        return res.json()["embeddings"]
+
+    @staticmethod
+    def _normalize(vectors):
+        matrix = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return (matrix / np.where(norms == 0, 1, norms)).tolist()
+
+    def _legacy_embed_documents(self, texts):
+        return self._normalize(super().embed_documents(texts)) if texts else []
+
+    def embed_documents(self, texts):
+        return self._truncate(self._embed_documents(texts))
+
+    def embed_query(self, text):
+        return self._truncate([self._embed_query(text)])[0]
+
+    def _embed_documents(self, texts):
+        if not self.batch_endpoint_available:
+            return self._legacy_embed_documents(texts)
+
+        inputs = [f"{self.embed_instruction}{text}" for text in texts]
+        # Similar lengths per batch means less padding in each forward pass
+        order = sorted(range(len(inputs)), key=lambda i: len(inputs[i]))
+        batches = [order[start:start + self.batch_size] for start in range(0, len(order), self.batch_size)]
+        if not batches:
+            return []
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as pool:
+            results = list(pool.map(lambda batch: self._embed_batch([inputs[i] for i in batch]), batches))
+        if any(result is None for result in results):
+            return self._legacy_embed_documents(texts)
+
+        vectors = [None] * len(inputs)
+        for batch, result in zip(batches, results):
+            for i, vector in zip(batch, result):
+                vectors[i] = vector
+        return vectors
+
+    def _embed_query(self, text):
+        if self.batch_endpoint_available:
+            result = self._embed_batch([f"{self.query_instruction}{text}"])
+            if result is not None:
+                return result[0]
+        return self._normalize([super().embed_query(text)])[0]
+
+
+def _onnx_embedder():
+    """In-process INT8 ONNX Runtime embeddings (needs sentence-transformers[onnx])."""
+    import onnxruntime as ort
+
+    sess_options = ort.SessionOptions()
+    sess_options.intra_op_num_threads = os.cpu_count() or 1
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return HuggingFaceEmbeddings(
+        model_name=ONNX_EMBED_MODEL,
+        model_kwargs={
+            "backend": "onnx",
+            "model_kwargs": {
+                "file_name": ONNX_EMBED_FILE,
+                "provider": "CPUExecutionProvider",
+                "session_options": sess_options,
+            },
+        },
+        encode_kwargs={"normalize_embeddings": True, "batch_size": EMBED_BATCH_SIZE},
+    )
+
+
+@lru_cache(maxsize=1)
+def get_embedder():
+    """Build the embedding model once per process; every caller shares it.
+
+    Document embeddings are cached under EMBED_CACHE_DIR keyed by a blake2b hash of
+    the chunk text, namespaced by backend, model and dimensions, so chunks that were
+    embedded before (re-uploads, edited documents) skip the embedding call.
+
+    Defaults to Ollama. EMBEDDING_BACKEND picks another one:
+
+    - ``infinity``: an Infinity server (dynamic batching, fp16), e.g. started with
+      ``infinity_emb v2 --model-id nomic-ai/nomic-embed-text-v1.5 --dtype float16 --batch-size 64``
+    - ``fastembed``: FastEmbed's quantized ONNX models in-process, for CPU-only hosts
+    - ``onnx``: sentence-transformers' INT8 ONNX export in-process
+
+    Vectors from different backends aren't comparable, so persisted indexes live
+    under embedding_namespace() too.
+    """
+    if EMBEDDING_BACKEND == "infinity":
+        embedder = InfinityEmbeddings(model=INFINITY_EMBED_MODEL, infinity_api_url=INFINITY_URL)
+    elif EMBEDDING_BACKEND == "fastembed":
+        embedder = FastEmbedEmbeddings(model_name=FASTEMBED_MODEL, batch_size=EMBED_BATCH_SIZE)
+    elif EMBEDDING_BACKEND == "onnx":
+        embedder = _onnx_embedder()
+    else:
+        embedder = BatchedOllamaEmbeddings(model=OLLAMA_EMBED_MODEL)
+
+    if not EMBED_CACHE_DIR:
+        return embedder
+    return CacheBackedEmbeddings.from_bytes_store(
+        embedder, LocalFileStore(EMBED_CACHE_DIR), namespace=embedding_namespace() + "/", key_encoder="blake2b"
+    )
+
+
+@lru_cache(maxsize=1)
+def embedding_namespace():
+    """``backend/model/dims`` of the configured embedder, as a relative path.
+
+    Restricted to characters LocalFileStore accepts, so it namespaces both the
+    embedding cache and persisted vector stores.
+    """
+    models = {"infinity": INFINITY_EMBED_MODEL, "fastembed": FASTEMBED_MODEL, "onnx": ONNX_EMBED_MODEL}
+    # "-ln": truncated vectors are layer-normed first, unlike ones cached before that fix
+    dims = f"{EMBED_DIMENSIONS}-ln" if EMBED_DIMENSIONS else "full"
+    parts = (EMBEDDING_BACKEND, models.get(EMBEDDING_BACKEND, OLLAMA_EMBED_MODEL), dims)
+    return "/".join(re.sub(r"[^A-Za-z0-9_.-]", "_", part) for part in parts)
+
+
 # ------------------------------------
 # Vector Store
 # ------------------------------------
-def create_vector_store(docs, persist_directory="chroma_db"):
-    """Create a Chroma vector store with Ollama embeddings."""
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+# Buffer inserts and flush the HNSW graph to disk rarely: a document is ingested in
+# one go, so per-batch graph updates and syncs are pure overhead
+CHROMA_COLLECTION_METADATA = {"hnsw:batch_size": 10_000, "hnsw:sync_threshold": 100_000}
+# Exact flat search stays sub-millisecond well past a single document's chunk count
+FAISS_MAX_CHUNKS = 50_000
+
+
+def _faiss_store(docs, persist_directory, embeddings):
+    """Exact cosine search: IndexFlatIP over L2-normalized vectors, saved with save_local."""
+    options = {"distance_strategy": DistanceStrategy.MAX_INNER_PRODUCT, "normalize_L2": True}
+    if docs:
+        logger.info("➕ Indexing %d documents in FAISS...", len(docs))
+        vector_store = FAISS.from_documents(docs, embeddings, **options)
+        vector_store.save_local(persist_directory)
+        return vector_store
+
+    # The docstore pickle is only ever written by this process's own save_local
+    return FAISS.load_local(
+        persist_directory, embeddings, allow_dangerous_deserialization=True, **options
+    )
+
+
+def _bulk_add(vector_store, docs, embeddings):
+    """Embed all chunks in one call and insert them with as few collection.add calls as Chroma allows."""
+    texts = [doc.page_content for doc in docs]
+    vectors = embeddings.embed_documents(texts)
+    ids = [f"chunk-{i}" for i in range(len(docs))]
+    metadatas = [doc.metadata or None for doc in docs]
+
+    step = vector_store._client.get_max_batch_size()
+    for start in range(0, len(ids), step):
+        end = start + step
+        vector_store._collection.add(
+            ids=ids[start:end],
+            embeddings=vectors[start:end],
+            documents=texts[start:end],
+            metadatas=metadatas[start:end],
+        )
+
+
+def create_vector_store(docs, persist_directory="chroma_db", embedder=None):
+    """Create or reopen a vector store with the shared embedding model.
+
+    Chroma by default. With VECTOR_BACKEND=faiss, documents under FAISS_MAX_CHUNKS
+    chunks go into a flat FAISS index instead, skipping HNSW inserts and SQLite
+    writes. A directory holding a saved FAISS index always reopens as FAISS.
+    """
     try:
-        embeddings = OllamaEmbeddings(model="nomic-embed-text")
+        embeddings = embedder if embedder is not None else get_embedder()
 
         os.makedirs(persist_directory, exist_ok=True)
-        print("🧠 Creating or connecting to Chroma vector store...")
 
-        # The new Chroma client doesn't require .persist()
-        vector_store = Chroma(
-            collection_name="rag_collection",
-            embedding_function=embeddings,
-            persist_directory=persist_directory,
+        use_faiss = os.path.exists(os.path.join(persist_directory, "index.faiss")) or (
+            VECTOR_BACKEND == "faiss" and docs and len(docs) < FAISS_MAX_CHUNKS
         )
+        if use_faiss:
+            logger.info("🧠 Creating or loading FAISS vector store...")
+            vector_store = _faiss_store(docs, persist_directory, embeddings)
+        else:
+            logger.info("🧠 Creating or connecting to Chroma vector store...")
 
-        if docs:
-            print(f"➕ Adding {len(docs)} documents to Chroma collection...")
-            vector_store.add_documents(docs)
+            # The new Chroma client doesn't require .persist()
+            vector_store = Chroma(
+                collection_name="rag_collection",
+                embedding_function=embeddings,
+                persist_directory=persist_directory,
+                collection_metadata=CHROMA_COLLECTION_METADATA,
+            )
+
+            if docs:
+                logger.info("➕ Adding %d documents to Chroma collection...", len(docs))
+                _bulk_add(vector_store, docs, embeddings)
 
         # Custom history tracking
         vector_store.qa_history = []
 
-        print("✅ Vector store ready.")
+        logger.info("✅ Vector store ready.")
         return vector_store
 
     except Exception as e:
-        print(f"❌ Vector store creation failed: {e}")
+        logger.error("❌ Vector store creation failed: %s", e)
         return None
 
 
+def vector_store_is_empty(vector_store):
+    """True when a reopened store has no documents in it."""
+    if isinstance(vector_store, FAISS):
+        return vector_store.index.ntotal == 0
+    return not vector_store.get(limit=1)["ids"]
+
+
 # ------------------------------------
 # RAG Chain
 # ------------------------------------
-def create_rag_chain(vector_store):
+@lru_cache(maxsize=1)
+def get_llm():
+    """The Ollama LLM, shared by every RAG chain in this process."""
+    return Ollama(model="llama3")
+
+
+def _stored_documents(vector_store):
+    """The chunks already held by a vector store, for stores reopened without their docs."""
+    if isinstance(vector_store, FAISS):
+        return list(vector_store.docstore._dict.values())
+    stored = vector_store.get(include=["documents", "metadatas"])
+    return [
+        Document(page_content=text, metadata=metadata or {})
+        for text, metadata in zip(stored["documents"], stored["metadatas"])
+    ]
+
+
+def build_retriever(vector_store, docs=None):
+    """Dense retrieval, fused with BM25 keyword retrieval when rank_bm25 is installed.
+
+    The hybrid pulls 2 chunks from each side and merges them by reciprocal rank,
+    matching exact terms (names, numbers) that embeddings tend to miss.
+    """
+    if not BM25_AVAILABLE:
+        return vector_store.as_retriever(search_kwargs={"k": 3})
+
+    docs = docs if docs is not None else _stored_documents(vector_store)
+    if not docs:
+        return vector_store.as_retriever(search_kwargs={"k": 3})
+    bm25 = BM25Retriever.from_documents(docs, k=2)
+    dense = vector_store.as_retriever(search_kwargs={"k": 2})
+    return EnsembleRetriever(retrievers=[bm25, dense], weights=[0.4, 0.6])
+
+
+def create_rag_chain(vector_store, docs=None):
     """Create a retrieval-based QA chain."""
     try:
         if vector_store is None:
             raise ValueError("Vector store not initialized")
 
-        print("🧩 Building RetrievalQA chain...")
-        retriever = vector_store.as_retriever(search_kwargs={"k": 3})
-        llm = Ollama(model="llama3")
+        logger.info("🧩 Building RetrievalQA chain...")
+        retriever = build_retriever(vector_store, docs)
+        llm = get_llm()
 
         chain = RetrievalQA.from_chain_type(
             llm=llm,
@@ -96,30 +435,52 @@ def create_rag_chain(vector_store):
             return_source_documents=True,
         )
 
-        print("✅ RAG chain created successfully.")
+        logger.info("✅ RAG chain created successfully.")
         return chain
     except Exception as e:
-        print(f"❌ RAG chain creation failed: {e}")
+        logger.error("❌ RAG chain creation failed: %s", e)
         return None
 
 
 # ------------------------------------
 # Store Q&A History
 # ------------------------------------
-def store_rag_answer(vector_store, answer: str, question: str, filename: str):
+HISTORY_DIR = os.path.join(os.path.dirname(__file__), "temp_files")
+
+
+def store_rag_answer(vector_store, answer: str, question: str, filename: str, persist: bool = True):
     """Save question-answer pairs in memory and optionally to disk."""
     try:
         if not hasattr(vector_store, "qa_history"):
             vector_store.qa_history = []
         vector_store.qa_history.append((question, answer))
 
-        os.makedirs("temp_files", exist_ok=True)
-        history_path = os.path.join("temp_files", f"{filename}_qa_history.json")
+        if persist:
+            persist_qa_history(vector_store, filename)
+    except Exception as e:
+        logger.warning("⚠️ Failed to store Q&A history: %s", e)
+
+
+def persist_qa_history(vector_store, filename: str):
+    """Append Q&A pairs not yet on disk to temp_files/<filename>_qa_history.jsonl.
+
+    One JSON array per line, so each save costs only the new pairs rather than
+    re-serializing the whole history.
+    """
+    try:
+        history = vector_store.qa_history
+        start = getattr(vector_store, "qa_persisted", 0)
+        end = len(history)
+        if start >= end:
+            return
 
-        with open(history_path, "w", encoding="utf-8") as f:
-            json.dump(vector_store.qa_history, f, ensure_ascii=False, indent=2)
+        os.makedirs(HISTORY_DIR, exist_ok=True)
+        history_path = os.path.join(HISTORY_DIR, f"{filename}_qa_history.jsonl")
+        with open(history_path, "ab") as f:
+            f.write(b"".join(orjson.dumps(pair, option=orjson.OPT_APPEND_NEWLINE) for pair in history[start:end]))
+        vector_store.qa_persisted = end
 
-        print(f"💾 Saved Q&A history → {history_path}")
+        logger.info("💾 Saved %d Q&A pairs → %s", end - start, history_path)
     except Exception as e:
-        print(f"⚠️ Failed to store Q&A history: {e}")
+        logger.warning("⚠️ Failed to store Q&A history: %s", e)
 
@@ -1,15 +1,51 @@
 import PyPDF2
 import docx
 import io
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:  # falls back to PyPDF2
+    pdfium = None
+
+# PyPDF2 is pure Python and holds the GIL, so big PDFs are split across processes
+PARALLEL_MIN_PAGES = 16
+PAGES_PER_TASK = 8
+
+def _extract_page_range(args):
+    """Extracts text from pages [start, stop) of a PDF given as bytes (runs in a worker)."""
+    pdf_bytes, start, stop = args
+    reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+    return "".join(reader.pages[i].extract_text() or "" for i in range(start, stop))
 
 def extract_text_from_pdf(file_stream):
-    """Extracts text from a PDF file stream using PyPDF2."""
+    """Extracts text from a PDF file stream with PDFium, or PyPDF2 if it isn't installed."""
     try:
+        if pdfium is not None:
+            pdf = pdfium.PdfDocument(file_stream)
+            try:
+                return "\n".join(page.get_textpage().get_text_range() for page in pdf)
+            finally:
+                pdf.close()
+
         reader = PyPDF2.PdfReader(file_stream)
-        text = ""
+        num_pages = len(reader.pages)
+        if num_pages >= PARALLEL_MIN_PAGES:
+            # Each worker re-opens the PDF, so hand out runs of pages rather than single ones
+            file_stream.seek(0)
+            pdf_bytes = file_stream.read()
+            ranges = [
+                (pdf_bytes, start, min(start + PAGES_PER_TASK, num_pages))
+                for start in range(0, num_pages, PAGES_PER_TASK)
+            ]
+            with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, len(ranges))) as pool:
+                return "".join(pool.map(_extract_page_range, ranges))
+
+        parts = []
         for page in reader.pages:
-            text += page.extract_text()
-        return text
+            parts.append(page.extract_text() or "")
+        return "".join(parts)
     except Exception as e:
         return f"Error extracting text from PDF: {e}"
 
@@ -17,10 +53,7 @@ def extract_text_from_docx(file_stream):
     """Extracts text from a DOCX file stream using python-docx."""
     try:
         doc = docx.Document(file_stream)
-        text = ""
-        for paragraph in doc.paragraphs:
-            text += paragraph.text + "\n"
-        return text
+        return "".join(paragraph.text + "\n" for paragraph in doc.paragraphs)
     except Exception as e:
         return f"Error extracting text from DOCX: {e}"
 
@@ -1,8 +1,156 @@
 import os
+import io
+import re
+import logging
+import queue
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from gtts import gTTS
 import gtts.lang
-from backend.llm_enrichment import enrich_text_with_llm
+from backend.llm_enrichment import enrich_chunks
 
+try:
+    import lameenc
+    from piper import PiperVoice
+except ImportError:  # optional: local synthesis needs piper-tts and lameenc
+    PiperVoice = None
+
+logger = logging.getLogger(__name__)
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+TTS_CHUNK_CHARS = 500
+TTS_WORKERS = 8
+
+
+@lru_cache(maxsize=1)
+def supported_langs():
+    """gTTS language codes; tts_langs() is looked up once per process, not per call."""
+    return frozenset(gtts.lang.tts_langs())
+
+
+def split_into_chunks(text, max_chars=TTS_CHUNK_CHARS):
+    """Group sentences into chunks of at most ``max_chars`` (a longer sentence stays whole)."""
+    chunks, current, size = [], [], 0
+    for sentence in SENTENCE_BOUNDARY.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if current and size + len(sentence) + 1 > max_chars:
+            chunks.append(" ".join(current))
+            current, size = [], 0
+        current.append(sentence)
+        size += len(sentence) + 1
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+@lru_cache(maxsize=None)
+def _piper_voice(lang_code):
+    """
+    Load the local Piper voice configured for a language, once per process.
+    Voices are ONNX models named by env, e.g. PIPER_VOICE_EN=/models/en_US-lessac-medium.onnx.
+    Returns None when Piper isn't installed or no voice is set, so callers use gTTS.
+    """
+    model_path = os.getenv(f"PIPER_VOICE_{lang_code.upper().replace('-', '_')}")
+    if PiperVoice is None or not model_path:
+        return None
+    try:
+        return PiperVoice.load(model_path)
+    except Exception as e:
+        logger.warning("⚠️ Could not load Piper voice %s, using gTTS: %s", model_path, e)
+        return None
+
+
+def _piper_to_mp3(voice, chunk):
+    """Synthesize a chunk locally and encode the 16-bit mono PCM as MP3."""
+    if hasattr(voice, "synthesize_stream_raw"):
+        pcm = b"".join(voice.synthesize_stream_raw(chunk))
+    else:  # piper-tts >= 1.3 yields AudioChunk objects
+        pcm = b"".join(c.audio_int16_bytes for c in voice.synthesize(chunk))
+    encoder = lameenc.Encoder()
+    encoder.set_bit_rate(64)
+    encoder.set_in_sample_rate(voice.config.sample_rate)
+    encoder.set_channels(1)
+    encoder.set_quality(2)
+    return bytes(encoder.encode(pcm) + encoder.flush())
+
+
+def _synthesize_chunk(chunk, lang_code):
+    """Render one text chunk to MP3 bytes in memory, locally with Piper when possible."""
+    voice = _piper_voice(lang_code)
+    if voice is not None:
+        try:
+            return _piper_to_mp3(voice, chunk)
+        except Exception as e:
+            logger.warning("⚠️ Piper synthesis failed, falling back to gTTS: %s", e)
+    buf = io.BytesIO()
+    gTTS(text=chunk, lang=lang_code).write_to_fp(buf)
+    return buf.getvalue()
+
+
+def stream_text_to_audio(text, lang_code="en", output_filename=None):
+    """
+    Yields MP3 bytes chunk by chunk, in order, while later chunks are still being
+    synthesized in parallel. MP3 frames concatenate cleanly, so the pieces form one
+    playable stream. When ``output_filename`` is given the full audio is also saved
+    there once the stream completes.
+
+    LLM enrichment and synthesis are pipelined: a producer thread queues TTS jobs
+    for each enriched piece as soon as Gemini returns it, so speech for the start
+    of the document is generated while later pieces are still being rewritten.
+    """
+    pool = ThreadPoolExecutor(max_workers=TTS_WORKERS)
+    pending = queue.Queue()  # TTS futures in document order; None marks the end
+    stop = threading.Event()
+    errors = []
+
+    def produce():
+        try:
+            for piece in enrich_chunks(text, lang_code=lang_code):
+                for chunk in split_into_chunks(piece):
+                    if stop.is_set():
+                        return
+                    pending.put(pool.submit(_synthesize_chunk, chunk, lang_code))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            pending.put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    # A private temp file per render: concurrent requests for the same output
+    # (double clicks, sessions sharing a document) must not write into one file
+    out = None
+    if output_filename:
+        out = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(os.path.abspath(output_filename)),
+            prefix=os.path.basename(output_filename) + ".",
+            suffix=".part",
+            delete=False,
+        )
+    completed = False
+    try:
+        while (future := pending.get()) is not None:
+            audio = future.result()
+            if out:
+                out.write(audio)
+            yield audio
+        if errors:
+            raise errors[0]
+        completed = True
+    finally:
+        # Client may disconnect mid-stream; don't keep synthesizing for nobody
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+        if out:
+            out.close()
+            if completed:
+                os.replace(out.name, output_filename)
+            else:
+                os.remove(out.name)
 
 def convert_text_to_audio(text, output_filename="audiobook.mp3", lang_code='en'):
     """
@@ -10,17 +158,15 @@ def convert_text_to_audio(text, output_filename="audiobook.mp3", lang_code='en')
     """
     try:
         # Check if the provided language is supported by gTTS
-        if lang_code not in gtts.lang.tts_langs():
-            print(f"Language not supported: {lang_code}")
+        if lang_code not in supported_langs():
+            logger.warning("Language not supported: %s", lang_code)
             return None
         
-        # Rewrite the text in the selected language using the LLM
-        enriched_text = enrich_text_with_llm(text, lang_code=lang_code)
-
-        # Use gTTS with the rewritten text and the specified language
-        tts = gTTS(text=enriched_text, lang=lang_code)
-        tts.save(output_filename)
+        # Same LLM rewrite and parallel chunked synthesis as the streaming endpoint,
+        # drained straight into the output file
+        for _ in stream_text_to_audio(text, lang_code=lang_code, output_filename=output_filename):
+            pass
         return output_filename
     except Exception as e:
-        print(f"An error occurred during TTS conversion: {e}")
+        logger.error("An error occurred during TTS conversion: %s", e)
         return None
\ No newline at end of file